@@ -1,27 +1,65 @@
 import ast
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 import networkx as nx
+import numpy as np
 import plotly.graph_objects as go
-from typing import Dict, Set, Tuple
+from typing import Dict, List, Tuple
 import json
 
-def parse_imports(file_path: str) -> Dict[str, Set[str]]:
-    with open(file_path, 'r') as file:
-        tree = ast.parse(file.read())
+try:
+    from fa2_modified import ForceAtlas2
+except ImportError:
+    ForceAtlas2 = None
 
-    imports = {}
-    for node in ast.walk(tree):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEF_OR_IMPORT_TOKENS = (b'def ', b'class ', b'import ', b'from ')
+SPRING_LAYOUT_MAX_NODES = 200
+KAMADA_KAWAI_MAX_NODES = 500
+HUGE_GRAPH_MIN_NODES = 5000
+FR_BLOCK_ROWS = 256
+FR_GRAVITY = 1.0
+
+def _load_tree(file_path: str) -> ast.Module:
+    # Bytes go straight to the parser, which honours PEP 263 coding cookies.
+    with open(file_path, 'rb') as file:
+        return ast.parse(file.read())
+
+def _iter_module_statements(statements: list, into_defs: bool = False):
+    # Yields statements only, never expressions. By default it stays at module
+    # level, looking inside top-level try/if/with/for/while/match blocks
+    # (guarded imports, TYPE_CHECKING, version checks) but not inside function
+    # or class bodies; into_defs=True descends into those as well.
+    for node in statements:
+        yield node
+        if not into_defs and isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        for field in ('body', 'orelse', 'handlers', 'finalbody', 'cases'):
+            yield from _iter_module_statements(getattr(node, field, []), into_defs)
+
+def _extract_imports(tree: ast.Module) -> List[Tuple[str, str]]:
+    # Lazy and optional imports inside functions and methods are real
+    # dependencies too, so descend into def bodies here.
+    imports = []
+    for node in _iter_module_statements(tree.body, into_defs=True):
         if isinstance(node, ast.Import):
-            for alias in node.names:
-                imports[alias.name] = {alias.name}
+            imports.extend((alias.name, alias.name) for alias in node.names)
         elif isinstance(node, ast.ImportFrom):
-            module = node.module or ''
-            for alias in node.names:
-                full_name = f"{module}.{alias.name}" if module else alias.name
-                imports[full_name] = {alias.name}
+            module = node.module
+            imports.extend(
+                (f"{module}.{alias.name}" if module else alias.name, alias.name)
+                for alias in node.names)
 
     return imports
 
+def parse_imports(file_path: str) -> List[Tuple[str, str]]:
+    return _extract_imports(_load_tree(file_path))
+
 def mark_dead_code(G: nx.DiGraph, file_nodes: Dict[str, str]):
     for file_node in file_nodes.values():
         if G.out_degree(file_node) == 0:
@@ -33,99 +71,204 @@ def read_file_content(file_path: str) -> str:
             return file.read()
     except Exception as e:
         return f"Error reading file: {str(e)}"
-    
-import json
-import plotly.graph_objects as go
-import networkx as nx
-import os
-import ast
-from typing import Tuple, Dict
 
-def get_function_code(node: ast.FunctionDef) -> str:
-    return ast.unparse(node)
+def get_code_location(file_path: str, node: ast.AST) -> Tuple[str, int, int]:
+    # The browser fetches the file and slices these lines on demand, so no
+    # source text is produced at build time. Decorators are included.
+    start = min([d.lineno for d in getattr(node, 'decorator_list', [])] + [node.lineno])
+    return file_path, start, node.end_lineno
+
+def _iter_py_files(directory: str):
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        # Skip unreadable directories, as os.walk does by default.
+        try:
+            entries = os.scandir(current)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.py'):
+                    yield entry.path
+
+def _analyze_file(file_path: str) -> Tuple[str, list, list, Dict[str, Tuple[str, int, int]]]:
+    # Runs in a worker process, so only plain picklable data is returned:
+    # node/edge batches ready for add_nodes_from/add_edges_from plus code locations.
+    file_node = file_path
+    nodes = [(file_node, {'color': 'blue', 'type': 'file'})]
+    edges = []
+    function_codes = {}
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
 
-def get_class_code(node: ast.ClassDef) -> str:
-    return ast.unparse(node)
+    # A substring scan is far cheaper than ast.parse; files with nothing we
+    # would extract (empty __init__.py, data modules) just get a file node.
+    if not any(token in data for token in DEF_OR_IMPORT_TOKENS):
+        return file_path, nodes, edges, function_codes
 
-def build_import_graph(directory: str) -> Tuple[nx.DiGraph, Dict[str, str], Dict[str, str]]:
+    tree = ast.parse(data)
+    function_attrs = {'color': 'green', 'type': 'function'}
+    class_attrs = {'color': 'red', 'type': 'class'}
+    module_attrs = {'color': 'yellow', 'type': 'module'}
+
+    for node in _iter_module_statements(tree.body):
+        if isinstance(node, ast.FunctionDef):
+            func_name = f"{file_node}::{node.name}"
+            nodes.append((func_name, function_attrs))
+            edges.append((file_node, func_name))
+            function_codes[func_name] = get_code_location(file_path, node)
+        elif isinstance(node, ast.ClassDef):
+            class_name = f"{file_node}::{node.name}"
+            nodes.append((class_name, class_attrs))
+            edges.append((file_node, class_name))
+            function_codes[class_name] = get_code_location(file_path, node)
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef):
+                    method_name = f"{class_name}::{item.name}"
+                    nodes.append((method_name, function_attrs))
+                    edges.append((class_name, method_name))
+                    function_codes[method_name] = get_code_location(file_path, item)
+
+    for imported_module, _ in _extract_imports(tree):
+        nodes.append((imported_module, module_attrs))
+        edges.append((file_node, imported_module))
+
+    return file_path, nodes, edges, function_codes
+
+def build_import_graph(directory: str) -> Tuple[nx.DiGraph, Dict[str, str], Dict[str, Tuple[str, int, int]]]:
     G = nx.DiGraph()
     file_nodes = {}
     function_codes = {}
-    class_codes = {}
-
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.py'):
-                file_path = os.path.join(root, file)
-                file_node = file_path
-                G.add_node(file_node, color='blue', type='file')
-                file_nodes[file_path] = file_node
-
-                with open(file_path, 'r') as f:
-                    tree = ast.parse(f.read())
-
-                for node in ast.walk(tree):
-                    if isinstance(node, ast.FunctionDef):
-                        func_name = f"{file_node}::{node.name}"
-                        G.add_node(func_name, color='green', type='function')
-                        G.add_edge(file_node, func_name)
-                        function_codes[func_name] = get_function_code(node)
-                    elif isinstance(node, ast.ClassDef):
-                        class_name = f"{file_node}::{node.name}"
-                        G.add_node(class_name, color='red', type='class')
-                        G.add_edge(file_node, class_name)
-                        class_codes[class_name] = get_class_code(node)
-                        for item in node.body:
-                            if isinstance(item, ast.FunctionDef):
-                                method_name = f"{class_name}::{item.name}"
-                                G.add_node(method_name, color='green', type='function')
-                                G.add_edge(class_name, method_name)
-                                function_codes[method_name] = get_function_code(item)
-
-                imports = parse_imports(file_path)
-                for imported_module, symbols in imports.items():
-                    G.add_node(imported_module, color='yellow', type='module')
-                    G.add_edge(file_node, imported_module)
-
-    return G, file_nodes, {**function_codes, **class_codes}
-
-def create_interactive_graph(G: nx.DiGraph, function_codes: Dict[str, str], output_file: str):
-    pos = nx.spring_layout(G, k=0.5, iterations=50)
-    
+    node_batches = []
+    edge_batches = []
+
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(_analyze_file, _iter_py_files(directory), chunksize=16)
+
+        for file_path, nodes, edges, file_function_codes in results:
+            file_nodes[file_path] = file_path
+            node_batches.append(nodes)
+            edge_batches.append(edges)
+            function_codes.update(file_function_codes)
+
+    G.add_nodes_from(chain.from_iterable(node_batches))
+    G.add_edges_from(chain.from_iterable(edge_batches))
+
+    return G, file_nodes, function_codes
+
+def _fr_energy(flat: np.ndarray, n: int, edges: np.ndarray, k: float,
+               gravity: float) -> Tuple[float, np.ndarray]:
+    # Fruchterman-Reingold energy: k^2 * log(d) repulsion between every pair
+    # plus d^3 / (3k) attraction along edges, with its analytic gradient.
+    # Gravity towards the origin keeps disconnected components from drifting
+    # off and squeezing the rest of the graph once the layout is rescaled.
+    pos = flat.reshape(n, 2)
+    sq_norms = (pos ** 2).sum(axis=1)
+    energy = 0.5 * gravity * sq_norms.sum()
+    grad = gravity * pos
+
+    # The pairwise terms are evaluated in row blocks so memory stays
+    # O(block * n) rather than O(n^2).
+    for start in range(0, n, FR_BLOCK_ROWS):
+        stop = min(start + FR_BLOCK_ROWS, n)
+        block = pos[start:stop]
+        rows = np.arange(stop - start)
+        dist2 = np.maximum(sq_norms[start:stop, None] + sq_norms[None, :] - 2 * block @ pos.T, 1e-9)
+        dist2[rows, rows + start] = 1.0
+
+        energy -= 0.25 * k * k * np.log(dist2).sum()
+        inv_dist2 = 1 / dist2
+        inv_dist2[rows, rows + start] = 0.0
+        grad[start:stop] -= k * k * (block * inv_dist2.sum(axis=1)[:, None] - inv_dist2 @ pos)
+
+    if len(edges):
+        edge_delta = pos[edges[:, 0]] - pos[edges[:, 1]]
+        edge_dist = np.sqrt((edge_delta ** 2).sum(axis=-1))
+        energy += (edge_dist ** 3).sum() / (3 * k)
+        edge_grad = edge_delta * (edge_dist / k)[:, None]
+        np.add.at(grad, edges[:, 0], edge_grad)
+        np.add.at(grad, edges[:, 1], -edge_grad)
+
+    return energy, grad.ravel()
+
+def _fr_lbfgs_layout(G: nx.DiGraph, maxiter: int = 200) -> Dict[str, np.ndarray]:
+    from scipy.optimize import minimize
+
+    nodes = list(G.nodes())
+    n = len(nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(index[u], index[v]) for u, v in G.edges() if u != v], dtype=np.intp).reshape(-1, 2)
+    k = 1 / np.sqrt(n)
+
+    x0 = np.random.default_rng().random(2 * n)
+    result = minimize(_fr_energy, x0, args=(n, edges, k, FR_GRAVITY), jac=True,
+                      method='L-BFGS-B', options={'maxiter': maxiter})
+    pos = nx.rescale_layout(result.x.reshape(n, 2))
+    return dict(zip(nodes, pos))
+
+def compute_layout(G: nx.DiGraph) -> Dict[str, np.ndarray]:
+    n = G.number_of_nodes()
+    if n < SPRING_LAYOUT_MAX_NODES:
+        # spring_layout already stops early once its mean displacement drops
+        # below `threshold`, so 50 is only an upper bound here.
+        return nx.spring_layout(G, k=0.5, iterations=50, threshold=1e-4)
+    if n <= KAMADA_KAWAI_MAX_NODES:
+        return nx.kamada_kawai_layout(G)
+
+    # Each pass over a huge graph is expensive; take fewer of them.
+    huge = n > HUGE_GRAPH_MIN_NODES
+    if ForceAtlas2 is not None:
+        # Barnes-Hut approximates the O(n^2) repulsion in O(n log n).
+        forceatlas2 = ForceAtlas2(barnesHutOptimize=True, barnesHutTheta=1.2, verbose=False)
+        return forceatlas2.forceatlas2_networkx_layout(G, pos=None, iterations=20 if huge else 100)
+    return _fr_lbfgs_layout(G, maxiter=50 if huge else 200)
+
+def create_interactive_graph(G: nx.DiGraph, function_codes: Dict[str, Tuple[str, int, int]], output_file: str):
+    pos = compute_layout(G)
+
+    # Build coordinate arrays in one pass; plotly breaks line segments at NaN.
+    # They are handed to plotly as lists because plotly>=6 would encode
+    # arrays as typed 'bdata' blobs, which the plotly.js on the page can't read.
+    nodes = list(G.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    coords = np.array([pos[node] for node in nodes], dtype=np.float64).reshape(-1, 2)
+    node_x, node_y = coords[:, 0], coords[:, 1]
+    edges = np.array([(index[u], index[v]) for u, v in G.edges()], dtype=np.intp).reshape(-1, 2)
+
+    edge_x = np.empty(3 * len(edges))
+    edge_x[0::3] = node_x[edges[:, 0]]
+    edge_x[1::3] = node_x[edges[:, 1]]
+    edge_x[2::3] = np.nan
+    edge_y = np.empty(3 * len(edges))
+    edge_y[0::3] = node_y[edges[:, 0]]
+    edge_y[1::3] = node_y[edges[:, 1]]
+    edge_y[2::3] = np.nan
+
     edge_trace = go.Scatter(
-        x=[], y=[],
+        x=edge_x.tolist(), y=edge_y.tolist(),
         line=dict(width=0.5, color='#888'),
         hoverinfo='none',
         mode='lines')
 
+    node_attrs = [G.nodes[node] for node in nodes]
+    node_colors = [attrs['color'] for attrs in node_attrs]
+    node_text = [f"{node}<br>Type: {attrs['type']}" for node, attrs in zip(nodes, node_attrs)]
+
     node_trace = go.Scatter(
-        x=[], y=[],
+        x=node_x.tolist(), y=node_y.tolist(),
         mode='markers',
         hoverinfo='text',
+        text=node_text,
         marker=dict(
             showscale=False,
-            color=[],
+            color=node_colors,
             size=30,
             line_width=2))
 
-    for edge in G.edges():
-        x0, y0 = pos[edge[0]]
-        x1, y1 = pos[edge[1]]
-        edge_trace['x'] += (x0, x1, None)
-        edge_trace['y'] += (y0, y1, None)
-
-    node_colors = []
-    node_text = []
-    for node in G.nodes():
-        x, y = pos[node]
-        node_trace['x'] += (x,)
-        node_trace['y'] += (y,)
-        node_colors.append(G.nodes[node]['color'])
-        node_text.append(f"{node}<br>Type: {G.nodes[node]['type']}")
-
-    node_trace.marker.color = node_colors
-    node_trace.text = node_text
-
     fig = go.Figure(data=[edge_trace, node_trace])
 
     fig.update_layout(
@@ -155,6 +298,15 @@ def create_interactive_graph(G: nx.DiGraph, function_codes: Dict[str, str], outp
         clickmode='event+select'
     )
 
+    # Write function/class locations next to the HTML file
+    codes_file = os.path.splitext(output_file)[0] + '.codes.json'
+    if orjson is not None:
+        with open(codes_file, 'wb') as f:
+            f.write(orjson.dumps(function_codes))
+    else:
+        with open(codes_file, 'w', encoding='utf-8') as f:
+            json.dump(function_codes, f, separators=(',', ':'), ensure_ascii=False)
+
     # Add custom JavaScript for click event
     custom_js = '''
     <script>
@@ -175,7 +327,47 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Existing click event handler for Plotly graph
     var graphDiv = document.getElementById('graph-div');
-    var functionCodes = %s;
+    var functionCodes = null;
+
+    var fileContents = {};
+
+    // Function and class locations ([path, firstLine, lastLine]) live in a
+    // sidecar JSON file and are only downloaded on the first such click.
+    function loadFunctionCodes() {
+        if (!functionCodes) {
+            functionCodes = fetch(%s)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(response.status + ' ' + response.statusText);
+                    }
+                    return response.json();
+                })
+                .catch(error => {
+                    // Forget the failed request so the next click retries it.
+                    functionCodes = null;
+                    throw error;
+                });
+        }
+        return functionCodes;
+    }
+
+    function loadFileContent(path) {
+        if (!fileContents[path]) {
+            fileContents[path] = fetch('/get_file_content?path=' + encodeURIComponent(path))
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(response.status + ' ' + response.statusText);
+                    }
+                    return response.text();
+                })
+                .catch(error => {
+                    delete fileContents[path];
+                    throw error;
+                });
+        }
+        return fileContents[path];
+    }
+
     graphDiv.on('plotly_click', function(data) {
         var point = data.points[0];
         var nodeInfo = point.text.split('<br>');
@@ -185,20 +377,31 @@ document.addEventListener('DOMContentLoaded', function() {
         var previewContent = document.getElementById('preview-content');
         
         if (nodeType === 'function' || nodeType === 'class') {
-            var code = functionCodes[nodeName];
-            if (code) {
-                previewContent.textContent = code;
-                previewDiv.style.display = 'block';
-            } else {
-                previewContent.textContent = 'Code not available';
+            loadFunctionCodes().then(codes => {
+                var location = codes[nodeName];
+                if (location) {
+                    return loadFileContent(location[0]).then(content => {
+                        var lines = content.split(/\\r\\n|\\r|\\n/);
+                        previewContent.textContent = lines.slice(location[1] - 1, location[2]).join('\\n');
+                        previewDiv.style.display = 'block';
+                    });
+                } else {
+                    previewContent.textContent = 'Code not available';
+                    previewDiv.style.display = 'block';
+                }
+            }).catch(error => {
+                previewContent.textContent = 'Could not load code for ' + nodeName + ': ' + error.message;
                 previewDiv.style.display = 'block';
-            }
+            });
         } else if (nodeType === 'file') {
-            fetch('/get_file_content?path=' + encodeURIComponent(nodeName))
-                .then(response => response.text())
+            loadFileContent(nodeName)
                 .then(content => {
                     previewContent.textContent = content;
                     previewDiv.style.display = 'block';
+                })
+                .catch(error => {
+                    previewContent.textContent = 'Could not load ' + nodeName + ': ' + error.message;
+                    previewDiv.style.display = 'block';
                 });
         } else {
             previewContent.textContent = 'No preview available for ' + nodeType + ': ' + nodeName;
@@ -207,27 +410,27 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 </script>
-    ''' % json.dumps(function_codes)
+    ''' % json.dumps(os.path.basename(codes_file))
 
     # Write HTML file
     with open(output_file, 'w') as f:
-        f.write(f'''
+        f.write('''
         <html>
         <head>
             <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
             <style>
-                body {{
+                body {
                     font-family: Arial, sans-serif;
                     margin: 0;
                     padding: 0;
                     overflow: hidden;
-                }}
-                #graph-div {{
+                }
+                #graph-div {
                     width: 100%;
                     height: 90vh;
                     margin: auto;
-                }}
-                .legend-container {{
+                }
+                .legend-container {
                     position: absolute;
                     top: 10px;
                     left: 10px;
@@ -237,17 +440,17 @@ document.addEventListener('DOMContentLoaded', function() {
                     z-index: 1;
                     border-radius: 8px;
                     box-shadow: 0px 0px 10px rgba(0,0,0,0.3);
-                }}
-                .legend-item {{
+                }
+                .legend-item {
                     margin-bottom: 5px;
-                }}
-                .legend-color {{
+                }
+                .legend-color {
                     display: inline-block;
                     width: 20px;
                     height: 20px;
                     vertical-align: middle;
                     margin-right: 10px;
-                }}
+                }
             </style>
         </head>
         <body>
@@ -258,12 +461,20 @@ document.addEventListener('DOMContentLoaded', function() {
                 <div class="legend-item"><div class="legend-color" style="background-color: red;"></div>Class Node</div>
                 <div class="legend-item"><div class="legend-color" style="background-color: yellow;"></div>Module Node</div>
             </div>
-            {preview_div}
+            ''')
+        f.write(preview_div)
+        f.write('''
             <script>
-                var graphData = {fig.to_json()};
+                var graphData = ''')
+        # Serialize the figure once and stream it straight into the file
+        # rather than building the whole page as one string.
+        f.write(fig.to_json())
+        f.write(''';
                 Plotly.newPlot('graph-div', graphData.data, graphData.layout);
             </script>
-            {custom_js}
+            ''')
+        f.write(custom_js)
+        f.write('''
         </body>
         </html>
         ''')